@@ -0,0 +1,122 @@
+import orjson
+import time
+from typing import List, Tuple
+from groq import Groq
+
+# Import from our local modules
+from src.schemas import ProposalState, Config
+from src.graph import GROQ_API_KEY, build_messages, extract_json_robust, coerce_tagger_output, score_pretagged
+
+# Batch jobs in any of these states will never produce (more) output.
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+# --- Helper Functions ---
+def write_batch_file(states: List[ProposalState], path: str) -> None:
+    """
+    Step 1: Write every (pre-rendered) prompt in Groq Batch (JSONL) format.
+    The proposal id is used as 'custom_id' so results can be matched back to rows.
+    """
+    with open(path, 'wb') as f:
+        for state in states:
+            request = {
+                "custom_id": state['proposal_id'],
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": Config.MODEL_NAME,
+                    "temperature": Config.TEMPERATURE,
+                    "messages": build_messages(state['prompt']),
+                    "response_format": {"type": "json_object"},
+                },
+            }
+            f.write(orjson.dumps(request) + b"\n")
+
+
+def submit_batch(client: Groq, path: str):
+    """Step 2: Upload the JSONL file and create the batch job."""
+    with open(path, 'rb') as f:
+        batch_file = client.files.create(file=f, purpose="batch")
+
+    return client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window=Config.BATCH_COMPLETION_WINDOW,
+    )
+
+
+def wait_for_batch(client: Groq, batch_id: str):
+    """Step 3: Poll the job until it reaches a terminal status."""
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in TERMINAL_STATUSES:
+            return batch
+        print(f"⏳ Batch {batch_id} is '{batch.status}', checking again in {Config.BATCH_POLL_SECONDS}s...")
+        time.sleep(Config.BATCH_POLL_SECONDS)
+
+
+def download_results(client: Groq, batch) -> dict:
+    """Step 4: Download the output file and map custom_id -> raw LLM content."""
+    if batch.status != "completed" or not batch.output_file_id:
+        return {}
+
+    contents = {}
+    raw = client.files.content(batch.output_file_id).read()
+    for line in raw.splitlines():
+        if not line.strip():
+            continue
+        try:
+            record = orjson.loads(line)
+            response = record.get('response') or {}
+            if record.get('error') or response.get('status_code') != 200:
+                continue
+            contents[record['custom_id']] = response['body']['choices'][0]['message']['content']
+        except (orjson.JSONDecodeError, AttributeError, KeyError, IndexError, TypeError):
+            # A malformed record only costs its own row (it gets retried via the graph)
+            continue
+
+    return contents
+
+
+# --- Batch Runner ---
+def run_batch(states: List[ProposalState]) -> Tuple[List[ProposalState], List[ProposalState]]:
+    """
+    Tags all proposals with a single Groq Batch job, bypassing the graph's Tagger node.
+    The batch output is fed straight into the Validator and Scorer.
+
+    Returns (finished, retry):
+    - finished: states that passed validation and were scored.
+    - retry: states that failed in the batch or failed validation.
+      These should be sent through the LangGraph path for self-correction.
+    """
+    client = Groq(api_key=GROQ_API_KEY)
+
+    write_batch_file(states, Config.BATCH_INPUT_FILE)
+    batch = submit_batch(client, Config.BATCH_INPUT_FILE)
+    print(f"📦 Submitted batch {batch.id} with {len(states)} proposals.")
+
+    batch = wait_for_batch(client, batch.id)
+    contents = download_results(client, batch)
+    print(f"📦 Batch {batch.id} finished with status '{batch.status}' ({len(contents)}/{len(states)} responses).")
+
+    finished, retry = [], []
+    for state in states:
+        content = contents.get(state['proposal_id'])
+        if content is None:
+            # No usable response: let the graph tag it from scratch.
+            retry.append(state)
+            continue
+
+        # Work on a copy so a bad row can't leave a half-updated state behind
+        scored = dict(state)
+        try:
+            scored.update(coerce_tagger_output(extract_json_robust(content)))
+            passed = score_pretagged(scored)
+        except Exception as e:
+            print(f"⚠️  Batch result for row {state['proposal_id']} unusable ({e}), retrying it via the graph.")
+            retry.append(state)
+            continue
+
+        (finished if passed else retry).append(scored)
+
+    return finished, retry
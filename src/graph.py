@@ -1,10 +1,13 @@
 import os
-import json
-import re
-from typing import Literal
+import orjson
+import hashlib
+import logging
+import functools
+from typing import List, Literal, Optional
 from dotenv import load_dotenv
-from langchain_groq import ChatGroq
-from langchain_core.messages import HumanMessage
+from groq import AsyncGroq, RateLimitError
+from aiolimiter import AsyncLimiter
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 from langgraph.graph import StateGraph, END
 
 # Import from our local schemas file
@@ -13,83 +16,354 @@ from src.schemas import ProposalState, Config
 # Load environment variables (API Key)
 load_dotenv()
 
+# Safety Check: API Key
+# Checked once at import time so a missing key fails fast, before any rows are processed.
+GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
+if not GROQ_API_KEY:
+    raise ValueError("GROQ_API_KEY not found. Please check your .env file.")
+
+logger = logging.getLogger(__name__)
+
+# Run-wide taxonomy (see set_taxonomy). Kept out of the graph state because it is
+# identical for every proposal and would otherwise be carried through every node.
+_ALLOWED: frozenset = frozenset()
+_TAXONOMY_PROMPT: str = ""
+_TAXONOMY_HASH: str = ""
+
+# How many LLM outputs needed the lenient json5 parser (if this gets high, fix the prompt).
+_json5_fallbacks = 0
+
+# How many candidates (parse attempts + rescans) extract_json_robust tries before giving up.
+# Real replies hold at most a few stray braces; this bounds pathological output.
+_MAX_SCAN_CANDIDATES = 16
+
 # --- Helper Functions ---
-def extract_json_robust(text: str) -> dict:
-    """Extracts JSON from LLM output, handling Markdown blocks."""
+def _parse_json_candidate(candidate: str, kind: type):
+    """
+    Strict parse first (fast path). Only on failure fall back to json5, which
+    accepts near-JSON (single quotes, trailing commas, unquoted keys) but is much slower.
+    Returns None if the candidate isn't valid (near-)JSON of the expected kind.
+    """
+    global _json5_fallbacks
+    try:
+        data = orjson.loads(candidate)
+    except orjson.JSONDecodeError:
+        pass
+    else:
+        return data if isinstance(data, kind) else None
+
+    # Imported lazily so the happy path never pays for it
+    import json5
+
+    _json5_fallbacks += 1
+    logger.debug("Strict JSON parse failed, using json5 fallback (%d so far)", _json5_fallbacks)
+    try:
+        data = json5.loads(candidate)
+    except ValueError:
+        return None
+    return data if isinstance(data, kind) else None
+
+
+def _top_level_spans(text: str, start: int, opener: str, closer: str):
+    """
+    Single pass over text from 'start' that yields (start, end) for every balanced
+    top-level opener...closer span, so nested objects are never re-scanned.
+    Brackets inside "..." or '...' strings are ignored; quotes outside any span are
+    just prose (e.g. "it's"). If the text ends inside an unclosed span, its start is
+    yielded as (start, -1) so the caller can rescan from just after it.
+    """
+    depth, quote, escaped, span_start = 0, None, False, -1
+
+    for i in range(start, len(text)):
+        ch = text[i]
+        if quote:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == quote:
+                quote = None
+        elif ch == opener:
+            if depth == 0:
+                span_start = i
+            depth += 1
+        elif depth == 0:
+            continue
+        elif ch in ('"', "'"):
+            quote = ch
+        elif ch == closer:
+            depth -= 1
+            if depth == 0:
+                yield span_start, i
+
+    if depth:
+        yield span_start, -1
+
+
+def extract_json_robust(text: str, opener: str = '{'):
+    """
+    Extracts a JSON object from LLM output.
+    With Groq JSON mode the whole reply is already valid JSON, so a single strict
+    parse is the happy path. Otherwise (other providers, fenced or chatty output) we
+    scan the text once for balanced top-level objects and return the first one that
+    parses (e.g. prose like "use the format {tags}" before the real object is skipped).
+    Pass opener='[' to extract a JSON array instead.
+    """
+    closer = '}' if opener == '{' else ']'
+    kind = dict if opener == '{' else list
+
+    # Fast path: server-side JSON mode
     try:
-        # Case 1: JSON is inside a markdown block
-        if "```" in text:
-            pattern = r"```(?:json)?\s*(\{.*?\})\s*```"
-            match = re.search(pattern, text, re.DOTALL)
-            if match: return json.loads(match.group(1))
-        
-        # Case 2: JSON is embedded in raw text (find first '{' and last '}')
-        start, end = text.find('{'), text.rfind('}')
-        if start != -1: return json.loads(text[start:end+1])
-        
-        # Case 3: Text is pure JSON
-        return json.loads(text)
-    except:
-        return {}
+        data = orjson.loads(text)
+    except orjson.JSONDecodeError:
+        pass
+    else:
+        if isinstance(data, kind):
+            return data
+
+    # An unclosed stray opener (e.g. "{tags" in prose) swallows the rest of the text,
+    # so the scan restarts just after it. The candidate cap keeps this O(n) overall.
+    budget = _MAX_SCAN_CANDIDATES
+    start = text.find(opener)
+    while start != -1 and budget > 0:
+        restart = -1
+        for span_start, end in _top_level_spans(text, start, opener, closer):
+            budget -= 1
+            if end == -1:
+                restart = text.find(opener, span_start + 1)
+                break
+            data = _parse_json_candidate(text[span_start:end + 1], kind)
+            if data is not None:
+                return data
+            if budget == 0:
+                break
+        start = restart
+
+    # Nothing parseable (e.g. truncated output)
+    return kind()
+
+
+@functools.lru_cache(maxsize=1)
+def _get_client() -> AsyncGroq:
+    """
+    Returns the shared async Groq client (raw SDK, no LangChain layers in between).
+    Reusing the client keeps its HTTP connection pool (keep-alive) warm across rows and retries.
+    SDK-level retries are disabled: 429 backoff is handled once, by _invoke_llm.
+    """
+    return AsyncGroq(api_key=GROQ_API_KEY, max_retries=0)
+
+
+@functools.lru_cache(maxsize=1)
+def _get_limiter() -> AsyncLimiter:
+    """Token bucket shared by every LLM request in the process (Config.RATE_LIMIT_RPM per minute)."""
+    return AsyncLimiter(Config.RATE_LIMIT_RPM, 60)
+
+
+@retry(
+    retry=retry_if_exception_type(RateLimitError),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    stop=stop_after_attempt(Config.LLM_MAX_ATTEMPTS),
+    reraise=True,
+)
+async def _invoke_llm(prompt: str) -> str:
+    """
+    Sends one prompt (with the shared taxonomy system prompt) to the LLM and returns its text.
+    JSON mode makes Groq constrain the output to a valid JSON object server-side.
+    Backs off (exponential + jitter) only when Groq actually answers HTTP 429,
+    instead of sleeping between every request.
+    Every attempt (graph retries and backoff retries included) takes a token from
+    the rate limiter, so RATE_LIMIT_RPM caps the real request rate.
+    """
+    async with _get_limiter():
+        resp = await _get_client().chat.completions.create(
+            model=Config.MODEL_NAME,
+            temperature=Config.TEMPERATURE,
+            messages=build_messages(prompt),
+            response_format={"type": "json_object"},
+        )
+    return resp.choices[0].message.content
+
+
+def _truncate_words(text: str, limit: int) -> str:
+    """Cuts text to at most `limit` chars without splitting a word."""
+    if len(text) <= limit:
+        return text
+    head = text[:limit + 1]
+    # A single word longer than the limit has no boundary to cut at
+    return head.rsplit(' ', 1)[0].rstrip(' ,;:') if ' ' in head else text[:limit]
+
+
+def render_taxonomy_prompt(taxonomy: dict) -> str:
+    """
+    Renders the constant part of the prompt (role, taxonomy, task), sent as the system message.
+    Computed once per run; keeping these bytes identical on every request lets
+    Groq's prompt caching reuse them across rows.
+    """
+
+    # Optimization: Simplify Taxonomy
+    # We strip out complex metadata and send ONLY one "- Name: Definition" line per tag
+    # (no JSON, no indentation). The tail of a definition is often what separates two
+    # tags, so definitions are only shortened when the whole block is over budget.
+    definitions = {name: ' '.join(meta.get('definition', '').split()) for name, meta in taxonomy.items()}
+    tag_lines = "\n".join(f"- {name}: {definition}" for name, definition in definitions.items())
+
+    if len(tag_lines) > Config.MAX_TAXONOMY_CHARS:
+        tag_lines = "\n".join(
+            f"- {name}: {_truncate_words(definition, Config.MAX_DEFINITION_CHARS)}"
+            for name, definition in definitions.items()
+        )
+
+    return (
+        "Role: Senior Data Classifier.\n"
+        f"Taxonomy:\n{tag_lines}\n\n"
+        "Task:\n"
+        "1. Classify the proposal using 1-3 tags from the list.\n"
+        "2. Extract a direct quote (evidence).\n"
+        "3. Explain reasoning."
+    )
+
+
+def set_taxonomy(tax: dict) -> None:
+    """
+    Registers the taxonomy for this run. Must be called once before the graph runs.
+    Precomputes the allowed tag set (Validator) and the system prompt (Tagger).
+    """
+    global _ALLOWED, _TAXONOMY_PROMPT, _TAXONOMY_HASH
+    _ALLOWED = frozenset(tax)
+    _TAXONOMY_PROMPT = render_taxonomy_prompt(tax)
+    _TAXONOMY_HASH = hashlib.sha1(_TAXONOMY_PROMPT.encode("utf-8")).hexdigest()
+
+
+def taxonomy_fingerprint() -> str:
+    """Short hash of the registered system prompt, so a resumed run can spot results from another taxonomy."""
+    return _TAXONOMY_HASH
+
+
+def build_messages(prompt: str) -> List[dict]:
+    """Chat messages for one request: shared taxonomy system prompt + per-row (or per-chunk) prompt."""
+    if not _TAXONOMY_PROMPT:
+        raise RuntimeError("No taxonomy registered. Call set_taxonomy() before tagging.")
+    return [
+        {"role": "system", "content": _TAXONOMY_PROMPT},
+        {"role": "user", "content": prompt},
+    ]
+
+
+def build_prompt(description: str) -> str:
+    """
+    Renders the per-row (user message) part of the prompt.
+    Called once per row in main.py, before the graph runs, and stored in state['prompt'].
+    """
+
+    # JSON mode guarantees the syntax, not the schema, so the field types are spelled out.
+    return (
+        'Return a JSON object with keys "tags" (a list of 1-3 tag names from the taxonomy), '
+        '"evidence" (a string), "reasoning" (a string).\n\n'
+        f'Proposal: "{description}"'
+    )
+
+
+def build_batch_prompt(descriptions: List[str]) -> str:
+    """
+    Multi-task variant of build_prompt: K proposals, numbered 1..K, in one request.
+    The taxonomy system prompt is sent once and shared by all K proposals.
+    """
+    proposals = "\n".join(f'{i}. "{d}"' for i, d in enumerate(descriptions, start=1))
+
+    return (
+        "Apply the task to EACH numbered proposal below.\n"
+        'Return a JSON object with key "results": a list with one object per proposal, '
+        'with keys "id", "tags" (a list of 1-3 tag names from the taxonomy), '
+        '"evidence" (a string), "reasoning" (a string).\n\n'
+        f"Proposals:\n{proposals}"
+    )
+
+
+def coerce_tagger_output(data: dict) -> dict:
+    """
+    Turns one parsed LLM result into Tagger fields with the types the Validator expects.
+    JSON mode only guarantees syntax: a null evidence or a list of objects as tags
+    must not crash the row, so anything of the wrong type is dropped.
+    A bare string tag is wrapped in a list (iterating it would yield single letters).
+    """
+    tags = data.get('tags')
+    if isinstance(tags, str):
+        tags = [tags]
+    evidence = data.get('evidence')
+    reasoning = data.get('reasoning')
+
+    return {
+        "proposed_tags": [t for t in tags if isinstance(t, str)] if isinstance(tags, list) else [],
+        "evidence": evidence if isinstance(evidence, str) else "",
+        "reasoning": reasoning if isinstance(reasoning, str) else "",
+    }
 
 
 # --- NODES (The Agents) ---
-def tagger_node(state: ProposalState) -> ProposalState:
+# Each node returns only the keys it changed; LangGraph merges that delta into the
+# running state, so unchanged (and potentially large) fields are never re-copied.
+async def tagger_node(state: ProposalState) -> dict:
     """
     Node 1: The 'Brain' (LLM) - Classify proposal using Groq/Llama3
     Responsibility: Read the proposal and attempt to classify it.
 
     """
     
-    # 1. Safety Check: API Key
-    api_key = os.environ.get("GROQ_API_KEY")
-    if not api_key:
-        raise ValueError("GROQ_API_KEY not found. Please check your .env file.")
-        
-    llm = ChatGroq(model=Config.MODEL_NAME, temperature=Config.TEMPERATURE, api_key=api_key)
-
-    # 2. Optimization: Simplify Taxonomy
-    # We strip out complex metadata and send ONLY (Name -> Definition) to the LLM.
-    simple_tax = {k: v.get('definition', '') for k, v in state['taxonomy'].items()}
-
-    # 3. Prompt Engineering
-    # We explicitly ask for "JSON ONLY" and specific fields (evidence/reasoning).
+    # 1. Remember the previous attempt so should_retry can detect a stable (repeated) answer.
+    # A failed call is not an answer, so it is recorded as None and never matches.
+    if state['llm_failed']:
+        previous = {"last_tags": None, "last_evidence": None}
+    else:
+        previous = {"last_tags": state['proposed_tags'], "last_evidence": state['evidence']}
 
-    prompt = f"""
-    Role: Senior Data Classifier.
-    Taxonomy: {json.dumps(simple_tax, indent=2)}
+    try:
+        # The prompt was pre-rendered in main.py (see build_prompt): this node is a pure LLM call
+        content = await _invoke_llm(state['prompt'])
+        data = extract_json_robust(content)
+        return {**previous, "llm_failed": False, **coerce_tagger_output(data)}
+    except Exception as e:
+        return {**previous, "llm_failed": True, "proposed_tags": [], "reasoning": f"LLM Error: {e}"}
 
-    Task:
-    1. Classify the proposal using 1-3 tags from the list.
-    2. Extract a direct quote (evidence).
-    3. Explain reasoning.
 
-    Proposal: "{state['description']}"
+async def batched_tagger_node(states: List[ProposalState]) -> List[Optional[dict]]:
+    """
+    Node 1 (multi-task variant): Classify K proposals with a single LLM request.
+    Not wired into the graph; main.py calls it per chunk and runs the Validator/Scorer per result.
 
-    Output JSON ONLY: {{ "tags": [], "evidence": "", "reasoning": "" }}
+    Returns one tagger update per state (same order). An entry is None when that
+    proposal's result could not be parsed, so the caller can fall back to single mode.
     """
+    prompt = build_batch_prompt([s['description'] for s in states])
 
     try:
-        res = llm.invoke([HumanMessage(content=prompt)])
-        data = extract_json_robust(res.content)
-        state['proposed_tags'] = data.get('tags', [])
-        state['evidence'] = data.get('evidence', "")
-        state['reasoning'] = data.get('reasoning', "")
-    except Exception as e:
-        state['reasoning'] = f"LLM Error: {e}"
-        state['proposed_tags'] = []
+        content = await _invoke_llm(prompt)
+
+        # Prefer the requested {"results": [...]} shape, but accept a bare array too.
+        results = extract_json_robust(content).get('results')
+        if not isinstance(results, list):
+            results = extract_json_robust(content, opener='[')
+    except Exception:
+        return [None] * len(states)
 
-    return state
+    # Ids may come back as 1 or "1"
+    by_id = {str(r.get('id')): r for r in results if isinstance(r, dict)}
 
+    updates = []
+    for i in range(1, len(states) + 1):
+        data = by_id.get(str(i))
+        updates.append(None if data is None else coerce_tagger_output(data))
+    return updates
 
-def validator_node(state: ProposalState) -> ProposalState:
+
+def validator_node(state: ProposalState) -> dict:
     """
     Node 2: The 'Police' - Deterministic check for hallucinations
     Responsibility: Check for hallucinations and data quality.
     No LLM is used here—pure Python for 100% reliability.
     """
 
-    allowed = set(state['taxonomy'].keys())
+    # Built once per run in set_taxonomy
+    allowed = _ALLOWED
     proposed = set(state['proposed_tags'])
 
     issues = []
@@ -106,23 +380,20 @@ def validator_node(state: ProposalState) -> ProposalState:
     if len(state['evidence']) < Config.MIN_EVIDENCE_CHARS:
         issues.append("Evidence too short")
 
-    state['validation_issues'] = issues
-    state['validation_passed'] = len(issues) == 0
-    return state
+    return {"validation_issues": issues, "validation_passed": not issues}
 
 
-def retry_node(state: ProposalState) -> ProposalState:
+def retry_node(state: ProposalState) -> dict:
     
     """
     Node 3: The 'Loop Manager' - Increment retry counter
     Responsibility: Increment the counter so we don't loop forever.
     """
 
-    state['retag_count'] += 1
-    return state
+    return {"retag_count": state['retag_count'] + 1}
 
 
-def scorer_node(state: ProposalState) -> ProposalState:
+def scorer_node(state: ProposalState) -> dict:
     
     """
     Node 4: The 'Judge' (Scoring) - Calculate confidence score and make final decision
@@ -134,24 +405,45 @@ def scorer_node(state: ProposalState) -> ProposalState:
     - +0.20: Reasoning Provided (Explanation > 15 chars)
     """
 
-    score = 0.0
-
-    # Calculate Component Scores
-    if state['validation_passed']: score += 0.5
-    if len(state['evidence']) > 30: score += 0.3
-    if len(state['reasoning']) > 15: score += 0.2
-
-    state['confidence_score'] = round(score, 2)
+    # Calculate Component Scores (booleans count as 0/1)
+    score = (
+        0.5 * state['validation_passed']
+        + 0.3 * (len(state['evidence']) > 30)
+        + 0.2 * (len(state['reasoning']) > 15)
+    )
 
     # Final Threshold Check
     if score >= Config.MIN_CONFIDENCE_TO_PUBLISH:
-        state['decision'] = "PUBLISH"
-        state['decision_rationale'] = f"Score {score} >= {Config.MIN_CONFIDENCE_TO_PUBLISH}"
+        decision = "PUBLISH"
+        rationale = f"Score {score} >= {Config.MIN_CONFIDENCE_TO_PUBLISH}"
     else:
-        state['decision'] = "HOLD"
-        state['decision_rationale'] = f"Issues: {state['validation_issues']}"
+        decision = "HOLD"
+        rationale = f"Issues: {state['validation_issues']}"
 
-    return state
+    return {
+        "confidence_score": round(score, 2),
+        "decision": decision,
+        "decision_rationale": rationale,
+    }
+
+
+# --- Out-of-Graph Helpers ---
+def score_pretagged(state: ProposalState) -> bool:
+    """
+    Runs the Validator (and, if it passes, the Scorer) on a state that was tagged
+    outside the graph (Groq Batch API or multi-task prompt). Updates the state in place.
+
+    Returns False when validation failed: the state should then go through the graph,
+    where the Tagger/Retry loop handles self-correction.
+    """
+    state.update(validator_node(state))
+    if not state['validation_passed']:
+        # The out-of-graph attempt counts as one try; the graph handles the rest.
+        state['retag_count'] += 1
+        return False
+
+    state.update(scorer_node(state))
+    return True
 
 
 def should_retry(state: ProposalState) -> Literal["retry", "score"]:
@@ -159,16 +451,33 @@ def should_retry(state: ProposalState) -> Literal["retry", "score"]:
     """
     Conditional Edge Logic:
     Decides whether to loop back to Tagger or move forward to Scoring.
+
+    Retries are skipped when another LLM call can't change the outcome. At
+    temperature 0 the model is deterministic, so if a retry repeated the previous
+    answer (same tags, or same too-short evidence) the next one will too.
+    That argument doesn't hold for transport/API errors, so a failed call always
+    gets its retry.
     """
-    if not state['validation_passed'] and state['retag_count'] < Config.MAX_RETRY_ATTEMPTS:
-        return "retry"
-    return "score"
+    if state['validation_passed'] or state['retag_count'] >= Config.MAX_RETRY_ATTEMPTS:
+        return "score"
+
+    if state['retag_count'] >= 1 and not state['llm_failed']:
+        # Stable output: the retry returned exactly the same tags
+        if state['proposed_tags'] == state['last_tags']:
+            return "score"
+
+        # Only the evidence is too short, and it didn't change since the last attempt
+        if state['validation_issues'] == ["Evidence too short"] and state['evidence'] == state['last_evidence']:
+            return "score"
+
+    return "retry"
 
 
 # --- Graph Builder ---
-def build_graph():
+def build_graph(checkpointer=None):
     """
     Constructs the LangGraph State Machine.
+    Pass a checkpointer (e.g. AsyncSqliteSaver) to persist each proposal's state per thread_id.
     """
     workflow = StateGraph(ProposalState)
 
@@ -195,4 +504,4 @@ def build_graph():
     # End: Scorer -> Finish
     workflow.add_edge("scorer", END)
 
-    return workflow.compile()
\ No newline at end of file
+    return workflow.compile(checkpointer=checkpointer)
\ No newline at end of file
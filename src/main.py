@@ -1,11 +1,241 @@
 import os
-import json
-import time
+import csv
+import orjson
+import asyncio
+import functools
 import pandas as pd
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 from src.schemas import Config
-from src.graph import build_graph
+from src.graph import build_graph, set_taxonomy, taxonomy_fingerprint, build_prompt, batched_tagger_node, score_pretagged
+from src.batch_tagger import run_batch
 
-def main():
+# Columns of the output CSV
+OUTPUT_FIELDS = ["id", "description", "tags", "decision", "confidence", "evidence", "rationale"]
+
+
+def write_result(writer, out, state, final):
+    """
+    Streams one finished row to the output CSV as soon as it is available.
+    Flushing per row means a crash mid-run keeps everything processed so far.
+    """
+    try:
+        if isinstance(final, Exception):
+            raise final
+
+        row = {
+            "id": final['proposal_id'],
+            "description": final['description'],
+            "tags": ", ".join(final['proposed_tags']),
+            "decision": final['decision'],
+            "confidence": final['confidence_score'],
+            "evidence": final['evidence'],
+            "rationale": final['decision_rationale']
+        }
+    except Exception as e:
+        print(f"❌ Error on row {state['proposal_id']}: {e}")   # Graceful failure: If one row crashes, don't kill the whole script.
+        return
+
+    # Visual feedback for the console user
+    icon = "🟢" if row['decision'] == "PUBLISH" else "🔴"
+    print(f"{icon} [{row['id']}] {row['decision']} (Conf: {row['confidence']})")
+
+    writer.writerow(row)
+    out.flush()
+
+
+def thread_config(state):
+    """Each proposal gets its own checkpoint thread, keyed by its id."""
+    return {"configurable": {"thread_id": state['proposal_id']}}
+
+
+def unique_ids(raw_ids):
+    """
+    Turns the input ids into unique checkpoint thread ids (also used as Batch custom_ids).
+    Missing ids fall back to the row position; repeats get a '#n' suffix instead of sharing a thread.
+    """
+    ids, seen = [], {}
+    for i, raw in enumerate(raw_ids):
+        proposal_id = str(i) if pd.isna(raw) or not str(raw).strip() else str(raw).strip()
+        seen[proposal_id] = seen.get(proposal_id, 0) + 1
+        if seen[proposal_id] > 1:
+            print(f"⚠️  Duplicate proposalId '{proposal_id}' on row {i}, using '{proposal_id}#{seen[proposal_id]}'.")
+            proposal_id = f"{proposal_id}#{seen[proposal_id]}"
+        ids.append(proposal_id)
+    return ids
+
+
+def is_resumable(snapshot, state):
+    """
+    A checkpoint only counts as done if its run reached END, got a real LLM answer
+    (rows held because every call errored are retried) and was made from this exact input and taxonomy.
+    """
+    values = snapshot.values
+    return (
+        not snapshot.next
+        and bool(values.get('decision'))
+        and not values.get('llm_failed')
+        and values.get('description') == state['description']
+        and values.get('prompt') == state['prompt']
+        and values.get('taxonomy_hash') == state['taxonomy_hash']
+    )
+
+
+async def split_completed(app, states):
+    """
+    Splits states into (completed, pending) based on their last checkpoint.
+    Stale checkpoints (edited description, other CSV, changed taxonomy) are re-tagged.
+    """
+    completed, pending = [], []
+    for state in states:
+        snapshot = await app.aget_state(thread_config(state))
+        if is_resumable(snapshot, state):
+            completed.append(snapshot.values)
+        else:
+            pending.append(state)
+    return completed, pending
+
+
+def split_duplicates(states, completed):
+    """
+    Splits states into (unique, duplicates). Each duplicate is paired with the first
+    row that has the same description (possibly one completed in a previous run),
+    which is the only one sent to the LLM.
+    """
+    first_by_description = {s['description']: s for s in completed}
+    unique, duplicates = [], []
+    for state in states:
+        original = first_by_description.setdefault(state['description'], state)
+        if original is state:
+            unique.append(state)
+        else:
+            duplicates.append((state, original))
+    return unique, duplicates
+
+
+async def checkpoint_result(app, state):
+    """Records a row finished outside the graph (Batch API / multi-task) as completed."""
+    await app.aupdate_state(thread_config(state), state, as_node="scorer")
+
+
+async def bounded_invoke(sem, app, state):
+    """
+    Runs a single proposal through the graph.
+    The semaphore caps in-flight rows; the RPM budget is enforced per LLM call (graph._invoke_llm).
+    """
+    async with sem:
+        return await app.ainvoke(state, config=thread_config(state))
+
+
+async def process_row(sem, app, state, emit):
+    """Runs one proposal through the graph and emits its result (or error) when done."""
+    try:
+        final = await bounded_invoke(sem, app, state)
+        emit(state, final)
+    except Exception as e:
+        emit(state, e)
+
+
+async def tag_chunk(sem, app, chunk, emit):
+    """
+    Multi-task mode: tags a chunk of proposals with one LLM request, then validates
+    and scores each result. Rows that can't be parsed, or fail validation, fall back
+    to the graph (single mode with retries).
+    """
+    async with sem:
+        updates = await batched_tagger_node(chunk)
+
+    fallback = []
+    for state, update in zip(chunk, updates):
+        if update is None:
+            fallback.append(state)
+            continue
+
+        # Work on a copy so a failure leaves the original row untouched for the fallback
+        scored = {**state, **update}
+        try:
+            if not score_pretagged(scored):
+                fallback.append(scored)
+                continue
+            await checkpoint_result(app, scored)
+        except Exception as e:
+            print(f"⚠️  Multi-task result for row {state['proposal_id']} unusable ({e}), retrying it on its own.")
+            fallback.append(state)
+            continue
+        emit(state, scored)
+
+    await asyncio.gather(*(process_row(sem, app, state, emit) for state in fallback))
+
+
+async def run_pipeline(app, states):
+    """
+    Tags every proposal and streams the results to Config.OUTPUT_FILE.
+    Rows already finished in a previous run (per the checkpointer) are not re-processed.
+    """
+    sem = asyncio.Semaphore(Config.MAX_CONCURRENCY)
+
+    # Resume: skip rows whose checkpoint already has a final decision
+    completed, states = await split_completed(app, states)
+    if completed:
+        print(f"♻️  Resuming: {len(completed)} proposals already processed in a previous run.")
+
+    # Dedupe: repeated descriptions are classified once and the result is reused
+    states, duplicates = split_duplicates(states, completed)
+
+    # Offline mode: tag everything in one Groq Batch job first.
+    # Only rows that fail in the batch (or fail validation) go through the graph.
+    batch_results = []
+    if Config.USE_BATCH and states:
+        try:
+            batch_results, states = await asyncio.to_thread(run_batch, states)
+        except Exception as e:
+            print(f"⚠️  Batch Error: {e}. Falling back to per-row processing.")
+
+    for state in batch_results:
+        await checkpoint_result(app, state)
+
+    # Results are streamed to the CSV row-by-row as they complete (order may differ from the input).
+    with open(Config.OUTPUT_FILE, 'w', newline='') as out:
+        writer = csv.DictWriter(out, fieldnames=OUTPUT_FIELDS)
+        writer.writeheader()
+        emit = functools.partial(write_result, writer, out)
+
+        for state in completed + batch_results:
+            emit(state, state)
+
+        # Rows already tagged once (failed Batch API validation) go straight to the graph
+        # for self-correction; only untagged rows are eligible for multi-task chunks.
+        retry_rows = [s for s in states if s['retag_count'] > 0]
+        untagged = [s for s in states if s['retag_count'] == 0]
+        if Config.BATCH_SIZE > 1:
+            chunks = [untagged[i:i + Config.BATCH_SIZE] for i in range(0, len(untagged), Config.BATCH_SIZE)]
+        else:
+            chunks = []
+            retry_rows += untagged
+
+        # Run the Agent concurrently (bounded by the semaphore; LLM calls by the rate limiter)
+        print(f"⚙️  Processing {len(states)} proposals (up to {Config.MAX_CONCURRENCY} concurrent requests)...")
+        outcomes = await asyncio.gather(
+            # Several proposals per request: the taxonomy system prompt is sent once per chunk.
+            *(tag_chunk(sem, app, chunk, emit) for chunk in chunks),
+            *(process_row(sem, app, state, emit) for state in retry_rows),
+            return_exceptions=True,
+        )
+        for chunk, outcome in zip(chunks, outcomes):
+            if isinstance(outcome, Exception):
+                print(f"❌ Error on chunk starting at row {chunk[0]['proposal_id']}: {outcome}")
+
+        # Every processed row is checkpointed, so duplicates copy the original's final state from there
+        for state, original in duplicates:
+            snapshot = await app.aget_state(thread_config(original))
+            if not snapshot.values.get('decision'):
+                emit(state, RuntimeError(f"Duplicate of failed row {original['proposal_id']}"))
+                continue
+            final = {**snapshot.values, "proposal_id": state['proposal_id']}
+            await checkpoint_result(app, final)
+            emit(state, final)
+
+
+async def main():
     print("🚀 Starting Agentic Pipeline (Modular)...")
     
     # --- STEP 1: LOAD & VALIDATE INPUTS ---
@@ -21,14 +251,21 @@ def main():
             )
             
         # Load the raw data
-        df = pd.read_csv(Config.INPUT_CSV)
+        # Only the columns in Config.INPUT_COLUMNS are parsed, as strings (no type inference).
+        df = pd.read_csv(
+            Config.INPUT_CSV,
+            usecols=lambda c: c in Config.INPUT_COLUMNS,
+            dtype={c: 'string' for c in Config.INPUT_COLUMNS},
+        )
+        # Empty descriptions become "" (not NaN) so downstream len() checks keep working
+        df['description'] = df['description'].fillna('')
 
         # Load the taxonomy schema
         # We handle two cases here: 
         # 1. The JSON is a direct dictionary of categories
         # 2. The JSON is wrapped in a "taxonomy" key (common artifact from Phase 1)
-        with open(Config.TAXONOMY_FILE, 'r') as f:
-            tax_raw = json.load(f)
+        with open(Config.TAXONOMY_FILE, 'rb') as f:
+            tax_raw = orjson.loads(f.read())
             # Handle potential nested 'taxonomy' key from Phase 1 output
             tax_dict = tax_raw.get('taxonomy', tax_raw)
             
@@ -39,51 +276,43 @@ def main():
         print(f"❌ Initialization Error: {e}")
         return
 
-    # --- STEP 2: BUILD THE AGENT ---
-    # Compile the LangGraph state machine once. 
-    app = build_graph()
-    final_results = []
+    # --- STEP 2: PREPARE THE INPUTS ---
+    # The taxonomy is identical for every row: register it once instead of copying it into each state.
+    set_taxonomy(tax_dict)
 
-    # --- STEP 3: RUN THE PIPELINE ---
-    print(f"⚙️  Processing...")
-    for i, row in df.iterrows():
-        try:
-            # Create a fresh state object for this specific proposal.
-            initial_state = {
-                "proposal_id": str(row.get('proposalId', i)),
-                "description": row['description'],
-                "taxonomy": tax_dict,
-                "retag_count": 0, "proposed_tags": [], "evidence": "",
-                "validation_passed": False, "validation_issues": []
-            }
-            
-            # Run the Agent
-            final = app.invoke(initial_state)
-            
-            # Visual feedback for the console user
-            icon = "🟢" if final['decision'] == "PUBLISH" else "🔴"
-            print(f"{icon} [{final['proposal_id']}] {final['decision']} (Conf: {final['confidence_score']})")
-
-            # Collect the structured output
-            final_results.append({
-                "id": final['proposal_id'],
-                "description": row['description'],
-                "tags": ", ".join(final['proposed_tags']),
-                "decision": final['decision'],
-                "confidence": final['confidence_score'],
-                "evidence": final['evidence'],
-                "rationale": final['decision_rationale']
-            })
-            
-            time.sleep(0.5) # Rate limit politeness
+    # Pull the two columns we need out as plain lists (much cheaper than a Series per row).
+    descriptions = df['description'].tolist()
+    if 'proposalId' in df.columns:
+        ids = unique_ids(df['proposalId'].tolist())
+    else:
+        ids = [str(i) for i in range(len(df))]
 
-        except Exception as e:
-            print(f"❌ Error on row {i}: {e}")   # Graceful failure: If one row crashes, don't kill the whole script.
+    # Create a fresh state object for every proposal up-front.
+    # Prompts are rendered here, so the Tagger node is a pure LLM call.
+    states = [
+        {
+            "proposal_id": proposal_id,
+            "description": description,
+            "prompt": build_prompt(description),
+            "taxonomy_hash": taxonomy_fingerprint(),
+            "retag_count": 0, "proposed_tags": [], "evidence": "",
+            "validation_passed": False, "validation_issues": [],
+            "last_tags": [], "last_evidence": "", "llm_failed": False,
+            # Cleared explicitly: LangGraph keeps keys missing from the input across runs on a thread,
+            # so a re-tagged row could otherwise carry a stale decision from its previous checkpoint.
+            "reasoning": "", "confidence_score": None, "decision": None, "decision_rationale": None
+        }
+        for proposal_id, description in zip(ids, descriptions)
+    ]
+
+    # --- STEP 3: BUILD THE AGENT & RUN THE PIPELINE ---
+    # Compile the LangGraph state machine once, with a SQLite checkpointer so an
+    # interrupted run can be resumed (delete Config.CHECKPOINT_DB to start from scratch).
+    async with AsyncSqliteSaver.from_conn_string(Config.CHECKPOINT_DB) as checkpointer:
+        app = build_graph(checkpointer)
+        await run_pipeline(app, states)
 
-    # --- STEP 4: EXPORT THE RESULTS ---
-    res_df = pd.DataFrame(final_results)
-    res_df.to_csv(Config.OUTPUT_FILE, index=False)
     print(f"\n✅ Pipeline Complete. Results saved to: {Config.OUTPUT_FILE}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
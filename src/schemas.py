@@ -1,5 +1,5 @@
 import os
-from typing import TypedDict, List, Literal
+from typing import TypedDict, List, Literal, Optional
 
 class Config:
     """Centralized System Thresholds & Configuration"""
@@ -7,6 +7,25 @@ class Config:
     # --- MODEL SETTINGS ---
     MODEL_NAME = "llama-3.3-70b-versatile"
     TEMPERATURE = 0.0
+    # The taxonomy is sent in full unless its tag block exceeds MAX_TAXONOMY_CHARS (input tokens
+    # dominate cost); only then is each definition cut, at a word boundary, to MAX_DEFINITION_CHARS.
+    MAX_TAXONOMY_CHARS = 2000
+    MAX_DEFINITION_CHARS = 120
+
+    # --- THROUGHPUT SETTINGS ---
+    # Rows are processed concurrently; keep these within the Groq account limits.
+    MAX_CONCURRENCY = 10
+    RATE_LIMIT_RPM = 30
+    # Attempts per LLM call when Groq returns 429 (rate limited)
+    LLM_MAX_ATTEMPTS = 5
+    # Proposals sent per LLM request (multi-task prompt). Set to 1 for one request per row.
+    BATCH_SIZE = 8
+
+    # --- BATCH API SETTINGS ---
+    # Offline CSV runs submit every prompt as one Groq Batch job (cheaper, no RPM limits).
+    USE_BATCH = True
+    BATCH_COMPLETION_WINDOW = "24h"
+    BATCH_POLL_SECONDS = 30
     
     # --- FILE PATH CONFIGURATION ---
     # This robustly finds the 'data' folder relative to this file
@@ -18,6 +37,14 @@ class Config:
     INPUT_CSV = os.path.join(DATA_DIR, 'proposals.csv')
     TAXONOMY_FILE = os.path.join(DATA_DIR, 'taxonomy.json')
     OUTPUT_FILE = os.path.join(DATA_DIR, 'tagged_results.csv')
+    BATCH_INPUT_FILE = os.path.join(DATA_DIR, 'batch_requests.jsonl')
+
+    # LangGraph checkpoints (one thread per proposal) used to resume interrupted runs
+    CHECKPOINT_DB = os.path.join(BASE_DIR, '.langgraph_cache.db')
+
+    # Columns read from INPUT_CSV (everything else is skipped at parse time).
+    # Add any extra column the pipeline needs here.
+    INPUT_COLUMNS = {'proposalId', 'description'}
 
     # --- DECISION LOGIC THRESHOLDS ---
     # These control the "Publish vs Hold" gate.
@@ -31,9 +58,11 @@ class ProposalState(TypedDict):
     The Memory Object passed between graph nodes.
     """
     # --- 1. Static Inputs (Read-Only) ---
+    # The taxonomy is run-wide and lives in graph.set_taxonomy(), not in the state.
     proposal_id: str
     description: str
-    taxonomy: dict
+    prompt: str  # Per-row user message, rendered once before the graph runs (taxonomy goes in the system message)
+    taxonomy_hash: str  # graph.taxonomy_fingerprint() at tagging time, checked when resuming a run
 
     # --- 2. Model Outputs (Mutable) ---
     # The Tagger node writes these.
@@ -46,9 +75,14 @@ class ProposalState(TypedDict):
     validation_passed: bool
     validation_issues: List[str]
     retag_count: int
+    # The previous Tagger attempt, used to stop retrying once the output is stable.
+    # None when that attempt was an LLM error (nothing to compare against).
+    last_tags: Optional[List[str]]
+    last_evidence: Optional[str]
+    llm_failed: bool  # True when the latest Tagger call raised (API/transport error)
 
     # --- 4. Final Outputs (Reporting) ---
-    # The Scorer node finalizes these for the CSV export
-    confidence_score: float
-    decision: Literal["PUBLISH", "HOLD"]
-    decision_rationale: str
\ No newline at end of file
+    # The Scorer node finalizes these for the CSV export (None until it has run)
+    confidence_score: Optional[float]
+    decision: Optional[Literal["PUBLISH", "HOLD"]]
+    decision_rationale: Optional[str]
\ No newline at end of file